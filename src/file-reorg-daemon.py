@@ -1,12 +1,14 @@
 import os
+import errno
+import heapq
+import shutil
 import time
 import signal
 import threading
 import logging
-from queue import Queue
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from prometheus_client import start_http_server, Counter, Summary
+from queue import Queue, Empty
+from inotify_simple import INotify, flags
+from prometheus_client import start_http_server, Counter, Gauge, Summary
 
 # Configure logging
 logging.basicConfig(
@@ -14,76 +16,301 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
+logger = logging.getLogger(__name__)
 
 # Prometheus Metrics
 FILES_PROCESSED = Counter('files_processed_total', 'Total number of files processed')
+FILES_FAILED = Counter('files_failed_total', 'Total number of files that failed to move')
 PROCESSING_TIME = Summary('file_processing_seconds', 'Time spent processing files')
-FILE_QUEUE_SIZE = Counter('file_queue_size', 'Current number of files in queue')
+FILE_QUEUE_SIZE = Gauge('file_queue_size', 'Current number of files in queue')
 
 # Configuration
 WATCH_DIRECTORY = "/path/to/watch"
 DESTINATION_DIRECTORY = "/path/to/destination"
 MAX_WORKERS = 4
+USE_POLLING = False  # Enable for NFS/CIFS mounts or non-Linux hosts, where inotify is unavailable
+POLL_INTERVAL = 60
+MAX_RETRIES = 3
+SETTLE_TIME = 5  # Seconds a swept file must go unmodified before it is moved
+
+# Directory prefixes with a trailing separator, so per-file paths are one concatenation
+WATCH_PREFIX = os.path.join(WATCH_DIRECTORY, "")
+DESTINATION_PREFIX = os.path.join(DESTINATION_DIRECTORY, "")
 
 # Queue for processing
 file_queue = Queue()
+# Long-lived worker threads, joined on shutdown
+workers = []
+# File names queued or in progress, so the sweep and inotify don't queue a file twice
+pending_files = set()
+pending_lock = threading.Lock()
+# Failed files waiting to be retried, as a heap of (due_time, attempts, name)
+retry_heap = []
+retry_cond = threading.Condition()
+# Moves since the last summary line: [count, total_seconds, slowest_seconds]
+move_stats = [0, 0.0, 0.0]
+stats_lock = threading.Lock()
+
+def process_file(name):
+    """Process a single file with error handling.
 
-def process_file(file_path):
-    """Process a single file with error handling."""
-    start_time = time.time()
+    Returns True on success or if the file was already moved by an earlier
+    queue entry, and False if the move should be retried.
+    """
+    start_time = time.perf_counter()
+    file_path = WATCH_PREFIX + name
+    destination_path = DESTINATION_PREFIX + name
     try:
-        destination_path = os.path.join(DESTINATION_DIRECTORY, os.path.basename(file_path))
-        os.rename(file_path, destination_path)
-        FILES_PROCESSED.inc()
-        logging.info(f"Moved {file_path} to {destination_path}")
+        try:
+            os.rename(file_path, destination_path)
+        except FileNotFoundError:
+            if os.path.lexists(file_path):
+                raise
+            # Reported twice (sweep and inotify, or two CLOSE_WRITEs) and already moved
+            logger.debug("Skipping %s, already moved", file_path)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Source and destination are on different filesystems
+            move_across_filesystems(file_path, destination_path)
     except Exception as e:
-        logging.error(f"Error processing {file_path}: {e}")
-    finally:
-        PROCESSING_TIME.observe(time.time() - start_time)
+        logger.error("Error processing %s: %s", file_path, e)
+        PROCESSING_TIME.observe(time.perf_counter() - start_time)
+        return False
+    elapsed = time.perf_counter() - start_time
+    PROCESSING_TIME.observe(elapsed)
+    FILES_PROCESSED.inc()
+    record_move(elapsed)
+    logger.debug("Moved %s to %s", file_path, destination_path)
+    return True
+
+def move_across_filesystems(src_path, dst_path):
+    """Copies a file with copy_file_range, keeping data in the kernel, then removes the source.
+
+    The source is only removed once the destination holds every byte of it
+    and the source was not modified during the copy.
+    """
+    with open(src_path, 'rb') as fsrc:
+        before = os.fstat(fsrc.fileno())
+        fdst = open(dst_path, 'wb')
+        # dst_path was created by this call, so remove it if the copy doesn't complete
+        try:
+            with fdst:
+                try:
+                    # Copy until EOF rather than to a size snapshot, so a file that grew is copied in full
+                    while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                        pass
+                except (AttributeError, OSError) as e:
+                    # copy_file_range is missing on non-Linux hosts and older kernels
+                    # reject it across filesystems; continue from the current offset
+                    if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                        raise
+                    shutil.copyfileobj(fsrc, fdst)
+                fdst.flush()
+                copied = os.fstat(fdst.fileno()).st_size
+                expected = os.fstat(fsrc.fileno()).st_size
+                if copied != expected:
+                    raise OSError(f"Short copy of {src_path}: {copied} of {expected} bytes")
+            shutil.copystat(src_path, dst_path)
+            # A writer still appending would otherwise lose data to the unlinked inode
+            after = os.fstat(fsrc.fileno())
+            if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+                raise OSError(f"{src_path} was modified while it was being copied")
+        except Exception:
+            try:
+                os.unlink(dst_path)
+            except OSError:
+                pass
+            raise
+        os.unlink(src_path)
+
+def record_move(elapsed):
+    """Adds a successful move to the stats for the next summary line."""
+    with stats_lock:
+        move_stats[0] += 1
+        move_stats[1] += elapsed
+        move_stats[2] = max(move_stats[2], elapsed)
+
+def log_summary(interval):
+    """Logs one aggregated line for the files moved since the last summary."""
+    with stats_lock:
+        count, total, slowest = move_stats
+        move_stats[:] = [0, 0.0, 0.0]
+    if count:
+        logger.info("Moved %d files in the last %.0f seconds, avg %.1f ms, slowest %.1f ms",
+                    count, interval, total / count * 1000, slowest * 1000)
+
+def enqueue_file(name):
+    """Adds a file in the watch directory to the processing queue unless it is already pending."""
+    with pending_lock:
+        if name in pending_files:
+            return
+        pending_files.add(name)
+    FILE_QUEUE_SIZE.inc()
+    file_queue.put((name, 0))
+
+def sweep_directory():
+    """Queues every settled file currently present in the watch directory.
+
+    Files modified within SETTLE_TIME may still be open by a writer and are
+    skipped. Returns True if any file was skipped for that reason.
+    """
+    deferred = False
+    now = time.time()
+    with os.scandir(WATCH_DIRECTORY) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if now - entry.stat().st_mtime < SETTLE_TIME:
+                deferred = True
+                continue
+            enqueue_file(entry.name)
+    return deferred
+
+def schedule_retry(name, attempts):
+    """Schedules a failed file for another attempt after an exponential backoff.
+
+    Returns False if the file has already used up MAX_RETRIES.
+    """
+    if attempts >= MAX_RETRIES:
+        return False
+    with retry_cond:
+        heapq.heappush(retry_heap, (time.monotonic() + 2 ** attempts, attempts + 1, name))
+        retry_cond.notify()
+    return True
+
+def retry_dispatcher():
+    """Puts failed files back on the queue once their backoff has elapsed."""
+    while True:
+        with retry_cond:
+            while not retry_heap or retry_heap[0][0] > time.monotonic():
+                timeout = retry_heap[0][0] - time.monotonic() if retry_heap else None
+                retry_cond.wait(timeout)
+            _, attempts, name = heapq.heappop(retry_heap)
+        FILE_QUEUE_SIZE.inc()
+        file_queue.put((name, attempts))
 
 def worker():
     """Worker function to process files from queue."""
     while True:
-        file_path = file_queue.get()
-        if file_path is None:
+        item = file_queue.get()
+        if item is None:
             break
-        process_file(file_path)
+        FILE_QUEUE_SIZE.dec()
+        name, attempts = item
+        retrying = False
+        try:
+            if not process_file(name):
+                retrying = schedule_retry(name, attempts)
+                if not retrying:
+                    FILES_FAILED.inc()
+                    logger.error("Giving up on %s after %d retries", WATCH_PREFIX + name, attempts)
+        finally:
+            # Files awaiting a retry stay pending so sweeps don't queue them again
+            if not retrying:
+                with pending_lock:
+                    pending_files.discard(name)
         file_queue.task_done()
 
 def monitor_directory():
-    """Monitors a directory and adds new files to the queue."""
-    class Handler(FileSystemEventHandler):
-        def on_created(self, event):
-            if not event.is_directory:
-                logging.info(f"New file detected: {event.src_path}")
-                FILE_QUEUE_SIZE.inc()
-                file_queue.put(event.src_path)
-    
-    observer = Observer()
-    observer.schedule(Handler(), WATCH_DIRECTORY, recursive=False)
-    observer.start()
+    """Monitors a directory and adds new files to the queue.
+
+    New files are picked up from inotify events; files already present at
+    startup are queued by a single sweep. With USE_POLLING the directory is
+    re-swept every POLL_INTERVAL seconds instead of watched. A summary of
+    completed moves is logged every POLL_INTERVAL seconds.
+    """
+    # CLOSE_WRITE rather than CREATE, so a file is only picked up once its writer is done
+    watch_flags = flags.CLOSE_WRITE | flags.MOVED_TO
+    inotify = None
+    if not USE_POLLING:
+        inotify = INotify()
+        inotify.add_watch(WATCH_DIRECTORY, watch_flags)
+    # When set, the monotonic time of the next sweep; used to revisit unsettled files
+    resweep_at = None
     try:
+        # Sweep after the watch is added so files created in between are not missed
+        if sweep_directory():
+            resweep_at = time.monotonic() + SETTLE_TIME
+        last_summary = time.monotonic()
         while True:
-            time.sleep(1)
+            if inotify:
+                timeout = POLL_INTERVAL
+                if resweep_at is not None:
+                    timeout = max(0, min(timeout, resweep_at - time.monotonic()))
+                for event in inotify.read(timeout=int(timeout * 1000)):
+                    if event.mask & flags.Q_OVERFLOW:
+                        # Events were dropped, so fall back to a full sweep
+                        logger.warning("inotify queue overflowed, rescanning watch directory")
+                        resweep_at = time.monotonic()
+                    elif event.mask & flags.IGNORED:
+                        # The watch is gone (directory deleted, moved or unmounted); if the
+                        # directory no longer exists add_watch raises and the daemon exits
+                        logger.error("inotify watch on %s was removed, re-adding it", WATCH_DIRECTORY)
+                        inotify.add_watch(WATCH_DIRECTORY, watch_flags)
+                        resweep_at = time.monotonic()
+                    elif event.name and not event.mask & flags.ISDIR:
+                        logger.debug("New file detected: %s%s", WATCH_PREFIX, event.name)
+                        enqueue_file(event.name)
+            else:
+                time.sleep(POLL_INTERVAL)
+                resweep_at = time.monotonic()
+            now = time.monotonic()
+            if resweep_at is not None and now >= resweep_at:
+                resweep_at = now + SETTLE_TIME if sweep_directory() else None
+            if now - last_summary >= POLL_INTERVAL:
+                log_summary(now - last_summary)
+                last_summary = now
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        pass
+    finally:
+        if inotify:
+            inotify.close()
 
 def signal_handler(sig, frame):
-    """Handles shutdown signals gracefully."""
-    logging.info("Shutdown signal received. Exiting...")
-    for _ in range(MAX_WORKERS):
+    """Handles shutdown signals by leaving the monitor loop.
+
+    This runs in the main thread, which may be holding pending_lock, so it
+    only raises; the workers are stopped once monitor_directory returns.
+    """
+    raise KeyboardInterrupt
+
+def stop_workers():
+    """Stops the worker threads after letting moves already in progress finish.
+
+    Files still queued are left in the watch directory for the startup sweep
+    to pick up next time.
+    """
+    logger.info("Shutdown signal received. Exiting...")
+    while True:
+        try:
+            file_queue.get_nowait()
+        except Empty:
+            break
+        file_queue.task_done()
+    for _ in workers:
         file_queue.put(None)
-    exit(0)
+    for thread in workers:
+        thread.join()
 
 if __name__ == "__main__":
     start_http_server(8000)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    
+
+    # Create the destination once up front rather than checking per file
+    os.makedirs(DESTINATION_DIRECTORY, exist_ok=True)
+
     # Start worker threads
-    for _ in range(MAX_WORKERS):
-        threading.Thread(target=worker, daemon=True).start()
-    
-    # Start monitoring directory
-    monitor_directory()
+    for i in range(MAX_WORKERS):
+        thread = threading.Thread(target=worker, name=f"reorg-worker-{i}", daemon=True)
+        thread.start()
+        workers.append(thread)
+    threading.Thread(target=retry_dispatcher, daemon=True).start()
+
+    # Start monitoring directory; returns once a shutdown signal is received
+    try:
+        monitor_directory()
+    finally:
+        stop_workers()